@@ -7,11 +7,13 @@ import os
 import sys
 from datetime import datetime, timedelta
 import logging
+from collections import defaultdict
 
 from airflow import DAG
 from airflow.operators.python import PythonOperator
 from airflow.operators.bash import BashOperator
 from airflow.utils.dates import days_ago
+from airflow.utils.trigger_rule import TriggerRule
 
 # Thêm đường dẫn đến thư mục scripts vào sys.path
 SCRIPT_DIR = "/opt/crawler/scripts"
@@ -20,11 +22,30 @@ sys.path.insert(0, SCRIPT_DIR)
 # Import các module từ scripts
 try:
     from config import Config
-    from netflix_crawler import NetflixDataCrawler, setup_logging
+    from netflix_crawler import NetflixDataCrawler, setup_logging, stop_logging
 except ImportError as e:
     logging.error(f"Error importing modules from {SCRIPT_DIR}: {e}")
     raise
 
+# Config được tạo một lần cho mỗi worker process
+_CONFIG = None
+
+def _get_config():
+    """
+    Lấy Config dùng chung, chỉ parse .env ở lần gọi đầu tiên
+    """
+    global _CONFIG
+    if _CONFIG is None:
+        _CONFIG = Config(env_path='/opt/crawler/.env')
+    return _CONFIG
+
+# Các nguồn được bật, mỗi nguồn là một task crawl riêng.
+# Đọc từ cấu hình mặc định để không phải parse .env mỗi lần scheduler parse DAG.
+SOURCES = [
+    name for name, source_cfg in Config.DEFAULT_CONFIG["data_sources"].items()
+    if source_cfg.get("enabled", True)
+]
+
 # DAG Arguments
 default_args = {
     'owner': 'airflow',
@@ -44,12 +65,38 @@ dag = DAG(
     schedule_interval='0 1 * * *',  # Chạy lúc 1:00 AM mỗi ngày
     catchup=False,
     tags=['netflix', 'crawler', 'movies'],
+    max_active_tasks=len(SOURCES),
 )
 
 # Task Functions
+def run_source_crawler(source, **context):
+    """
+    Crawl danh sách phim của một nguồn, trả về các cặp [movie ID, popularity] qua XCom
+    """
+    setup_logging(log_dir='/opt/crawler/data/logs')
+    logging.info(f"Crawling source {source} from Airflow DAG")
+    
+    try:
+        config = _get_config()
+        num_pages = config.get_nested("data_sources", source, "pages",
+                                      default=config.get("max_pages_per_source", 5))
+        
+        # Context manager đóng HTTP session và cache khi xong
+        with NetflixDataCrawler(config) as crawler:
+            movies = crawler.crawl_movie_list(source, num_pages)
+        
+        return [[movie['id'], movie.get('popularity') or 0] for movie in movies]
+        
+    except Exception as e:
+        logging.error(f"Error crawling source {source}: {e}")
+        raise
+    finally:
+        # Task runner thoát bằng os._exit() nên phải tự ghi nốt log trong queue
+        stop_logging()
+
 def run_netflix_crawler(**context):
     """
-    Chạy Netflix crawler và thu thập dữ liệu mới
+    Gộp movie IDs từ các task theo nguồn và crawl thông tin chi tiết
     """
     # Setup logging
     logger = setup_logging(log_dir='/opt/crawler/data/logs')
@@ -57,16 +104,27 @@ def run_netflix_crawler(**context):
     
     try:
         # Load configuration
-        config = Config(env_path='/opt/crawler/.env')
+        config = _get_config()
         
-        # Create crawler
-        crawler = NetflixDataCrawler(config)
+        # Gộp kết quả của các task crawl theo nguồn
+        found_in = defaultdict(set)
+        popularity = {}
+        for source in SOURCES:
+            movies = context['ti'].xcom_pull(task_ids=f'crawl_{source}') or []
+            for movie_id, movie_popularity in movies:
+                found_in[movie_id].add(source)
+                popularity[movie_id] = movie_popularity
+        movie_sources = {movie_id: sorted(srcs) for movie_id, srcs in found_in.items()}
         
-        # Run crawl
-        result = crawler.crawl_daily_netflix_data(
-            num_pages_per_source=5,
-            max_movies=100
-        )
+        # Create crawler and run crawl
+        with NetflixDataCrawler(config) as crawler:
+            result = crawler.crawl_daily_netflix_data(
+                num_pages_per_source=5,
+                max_movies=100,
+                sources=SOURCES,
+                movie_sources=movie_sources,
+                popularity=popularity
+            )
         
         # Push metadata to XCom for downstream tasks
         context['ti'].xcom_push(key='crawl_timestamp', 
@@ -81,6 +139,9 @@ def run_netflix_crawler(**context):
     except Exception as e:
         logging.error(f"Error in Netflix crawler: {e}")
         raise
+    finally:
+        # Task runner thoát bằng os._exit() nên phải tự ghi nốt log trong queue
+        stop_logging()
 
 def clear_old_cache(**context):
     """
@@ -92,15 +153,16 @@ def clear_old_cache(**context):
     
     try:
         # Load configuration
-        config = Config(env_path='/opt/crawler/.env')
+        config = _get_config()
         
         # Tạo cache manager
         cache = CacheManager(config)
         
         # Xóa cache cũ hơn 7 ngày
         deleted = cache.clear(older_than=7*86400)  # 7 days in seconds
+        cache.close()
         
-        logging.info(f"Cleared {deleted} old cache files")
+        logging.info(f"Cleared {deleted} old cache entries")
         return deleted
         
     except Exception as e:
@@ -108,10 +170,24 @@ def clear_old_cache(**context):
         raise
 
 # Define Tasks
+source_tasks = [
+    PythonOperator(
+        task_id=f'crawl_{source}',
+        python_callable=run_source_crawler,
+        op_kwargs={'source': source},
+        provide_context=True,
+        dag=dag,
+    )
+    for source in SOURCES
+]
+
+# Chạy khi mọi task nguồn đã kết thúc, kể cả khi có nguồn thất bại:
+# nguồn lỗi không có XCom và được bỏ qua khi gộp
 crawl_task = PythonOperator(
     task_id='crawl_netflix_data',
     python_callable=run_netflix_crawler,
     provide_context=True,
+    trigger_rule=TriggerRule.ALL_DONE,
     dag=dag,
 )
 
@@ -132,4 +208,4 @@ log_results = BashOperator(
 )
 
 # Define task dependencies
-crawl_task >> clear_cache_task >> log_results
\ No newline at end of file
+source_tasks >> crawl_task >> clear_cache_task >> log_results
\ No newline at end of file
@@ -6,13 +6,66 @@ Quản lý cache cho API responses để tối ưu hiệu suất
 import os
 import json
 import time
+import sqlite3
 import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    # orjson là tùy chọn, dùng json chuẩn nếu chưa được cài
+    orjson = None
+
+
+@lru_cache(maxsize=4096)
+def _hash_cache_key(endpoint, frozen_params):
+    """
+    Băm endpoint và parameters thành cache key (kết quả được memoize).
+    
+    Args:
+        endpoint: API endpoint
+        frozen_params: frozenset (hoặc iterable) các cặp (key, value) của parameters
+        
+    Returns:
+        str: BLAKE2b hash (16 byte) dạng hex
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(endpoint.encode())
+    for k, v in sorted(frozen_params, key=lambda item: str(item[0])):
+        h.update(b'\x00')
+        h.update(str(k).encode())
+        h.update(b'=')
+        h.update(str(v).encode())
+    return h.hexdigest()
+
+
+def _encode(data):
+    """Serialize dữ liệu thành bytes để lưu vào cache."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _decode(payload):
+    """Deserialize bytes từ cache thành dữ liệu Python."""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+# Giá trị CacheManager.get() trả về khi request đã được ghi nhận là thất bại (negative cache)
+NEGATIVE_HIT = object()
+
+
 class CacheManager:
     """
     Quản lý cache cho API responses để giảm thiểu các lần gọi API không cần thiết.
+    
+    Tất cả entries được lưu trong một file SQLite duy nhất (cache.db) trong cache_dir.
     """
     
     def __init__(self, config):
@@ -20,11 +73,29 @@ class CacheManager:
         self.cache_dir = config.get("cache_dir")
         self.use_cache = config.get("use_cache", True)
         self.cache_ttl = config.get("cache_ttl", 86400)  # 24 giờ mặc định
+        self.db_path = os.path.join(self.cache_dir, "cache.db")
         
-        # Tạo thư mục cache nếu chưa tồn tại
+        # Kết nối SQLite được dùng chung giữa các thread, truy cập qua lock
+        self._lock = threading.Lock()
+        self._conn = None
+        
+        # Cache LRU trong bộ nhớ phía trước SQLite: key -> (thời điểm hết hạn, data)
+        self._mem = OrderedDict()
+        self._mem_max = 512
+        
+        # Tạo thư mục và database cache nếu chưa tồn tại
         if self.use_cache:
             os.makedirs(self.cache_dir, exist_ok=True)
-            logging.debug(f"Cache sẵn sàng tại: {self.cache_dir}")
+            self._conn = sqlite3.connect(self.db_path, isolation_level=None,
+                                         check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, ts REAL NOT NULL, payload BLOB NOT NULL, ttl REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_ts ON cache (ts)")
+            logging.debug("Cache sẵn sàng tại: %s", self.db_path)
     
     def _get_cache_key(self, endpoint, params):
         """
@@ -35,13 +106,15 @@ class CacheManager:
             params: Dict các parameters
             
         Returns:
-            str: MD5 hash làm cache key
+            str: BLAKE2b hash làm cache key
         """
-        # Sắp xếp params để đảm bảo key nhất quán
-        param_str = json.dumps(params, sort_keys=True) if params else "{}"
-        # Tạo hash của endpoint và parameters
-        key = hashlib.md5(f"{endpoint}:{param_str}".encode()).hexdigest()
-        return key
+        if not params:
+            return _hash_cache_key(endpoint, frozenset())
+        try:
+            return _hash_cache_key(endpoint, frozenset(params.items()))
+        except TypeError:
+            # Giá trị không hash được (vd. list) thì băm trực tiếp, không memoize
+            return _hash_cache_key.__wrapped__(endpoint, params.items())
     
     def get(self, endpoint, params=None):
         """
@@ -52,29 +125,44 @@ class CacheManager:
             params: Dict các parameters
             
         Returns:
-            Dict: Dữ liệu từ cache hoặc None nếu không có cache hợp lệ
+            Dict: Dữ liệu từ cache, NEGATIVE_HIT nếu request đã được ghi nhận là thất bại,
+                  hoặc None nếu không có cache hợp lệ
         """
         if not self.use_cache:
             return None
             
         cache_key = self._get_cache_key(endpoint, params)
-        cache_path = os.path.join(self.cache_dir, f"{cache_key}.json")
+        now = time.time()
         
-        # Kiểm tra file cache có tồn tại và chưa hết hạn
-        if os.path.exists(cache_path):
-            cache_time = os.path.getmtime(cache_path)
-            if (time.time() - cache_time) <= self.cache_ttl:
-                try:
-                    with open(cache_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        logging.debug(f"Cache hit: {endpoint}")
-                        return data
-                except Exception as e:
-                    logging.warning(f"Không thể đọc cache cho {endpoint}: {e}")
+        # Thử cache trong bộ nhớ trước
+        with self._lock:
+            entry = self._mem.get(cache_key)
+            if entry is not None:
+                if now <= entry[0]:
+                    self._mem.move_to_end(cache_key)
+                    logging.debug("Memory cache hit: %s", endpoint)
+                    return self._unwrap(entry[1])
+                del self._mem[cache_key]
+        
+        try:
+            # Chỉ lấy entry chưa hết hạn (ttl NULL = dùng cache_ttl mặc định)
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT ts + COALESCE(ttl, ?), payload FROM cache "
+                    "WHERE key = ? AND ts + COALESCE(ttl, ?) >= ?",
+                    (self.cache_ttl, cache_key, self.cache_ttl, now)
+                ).fetchone()
+            if row is not None:
+                data = _decode(row[1])
+                self._remember(cache_key, row[0], data)
+                logging.debug("Cache hit: %s", endpoint)
+                return self._unwrap(data)
+        except Exception as e:
+            logging.warning("Không thể đọc cache cho %s: %s", endpoint, e)
         
         return None
     
-    def set(self, endpoint, params, data):
+    def set(self, endpoint, params, data, ttl=None):
         """
         Lưu dữ liệu vào cache.
         
@@ -82,28 +170,127 @@ class CacheManager:
             endpoint: API endpoint
             params: Dict các parameters
             data: Dữ liệu để cache
+            ttl: Thời gian sống (giây) của entry (None = dùng cache_ttl)
             
         Returns:
             bool: True nếu lưu thành công, False nếu thất bại
         """
         if not self.use_cache or data is None:
             return False
+        
+        try:
+            payload = _encode(data)
+        except Exception as e:
+            logging.warning("Không thể ghi cache cho %s: %s", endpoint, e)
+            return False
+        
+        return self.set_raw(endpoint, params, payload, data, ttl=ttl)
+    
+    def set_negative(self, endpoint, params, status_code, ttl):
+        """
+        Ghi nhận một request thất bại vĩnh viễn để các lần gọi sau không cần gọi lại API.
+        
+        Args:
+            endpoint: API endpoint
+            params: Dict các parameters
+            status_code: HTTP status code của lỗi
+            ttl: Thời gian sống (giây) của entry
+            
+        Returns:
+            bool: True nếu lưu thành công, False nếu thất bại
+        """
+        return self.set(endpoint, params, {"__miss__": status_code}, ttl=ttl)
+    
+    def set_raw(self, endpoint, params, payload, data=None, ttl=None):
+        """
+        Lưu JSON đã serialize sẵn (ví dụ body của HTTP response) vào cache mà không encode lại.
+        
+        Args:
+            endpoint: API endpoint
+            params: Dict các parameters
+            payload: JSON dạng bytes
+            data: Dữ liệu đã decode tương ứng để đưa vào cache bộ nhớ (tùy chọn)
+            ttl: Thời gian sống (giây) của entry (None = dùng cache_ttl)
+            
+        Returns:
+            bool: True nếu lưu thành công, False nếu thất bại
+        """
+        if not self.use_cache or payload is None:
+            return False
             
         cache_key = self._get_cache_key(endpoint, params)
-        cache_path = os.path.join(self.cache_dir, f"{cache_key}.json")
         
         try:
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
-            logging.debug(f"Cache set: {endpoint}")
+            now = time.time()
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, ts, payload, ttl) VALUES (?, ?, ?, ?)",
+                    (cache_key, now, payload, ttl)
+                )
+            if data is not None:
+                self._remember(cache_key, now + (self.cache_ttl if ttl is None else ttl), data)
+            logging.debug("Cache set: %s", endpoint)
             return True
         except Exception as e:
-            logging.warning(f"Không thể ghi cache cho {endpoint}: {e}")
+            logging.warning("Không thể ghi cache cho %s: %s", endpoint, e)
             return False
     
+    @staticmethod
+    def _unwrap(data):
+        """Chuyển entry negative cache thành NEGATIVE_HIT."""
+        if isinstance(data, dict) and "__miss__" in data:
+            return NEGATIVE_HIT
+        return data
+    
+    def _remember(self, cache_key, expires_at, data):
+        """
+        Đưa entry vào cache bộ nhớ, loại bỏ entry cũ nhất khi vượt quá dung lượng.
+        
+        Args:
+            cache_key: Cache key
+            expires_at: Thời điểm entry hết hạn
+            data: Dữ liệu đã decode
+        """
+        with self._lock:
+            self._mem[cache_key] = (expires_at, data)
+            self._mem.move_to_end(cache_key)
+            while len(self._mem) > self._mem_max:
+                self._mem.popitem(last=False)
+    
     def clear(self, older_than=None):
         """
-        Xóa cache files.
+        Xóa cache entries.
+        
+        Args:
+            older_than: Xóa các entry cũ hơn số giây này (None = xóa tất cả)
+            
+        Returns:
+            int: Số entry đã xóa
+        """
+        if not self.use_cache:
+            return 0
+        
+        try:
+            with self._lock:
+                self._mem.clear()
+                if older_than is None:
+                    cursor = self._conn.execute("DELETE FROM cache")
+                else:
+                    cursor = self._conn.execute("DELETE FROM cache WHERE ts < ?",
+                                                (time.time() - older_than,))
+            deleted_count = cursor.rowcount
+        except Exception as e:
+            logging.warning("Không thể xóa cache: %s", e)
+            return 0
+        
+        deleted_count += self._clear_legacy_files(older_than)
+        
+        logging.info("Đã xóa %d cache entries", deleted_count)
+        return deleted_count
+    
+    def _clear_legacy_files(self, older_than=None):
+        """
+        Xóa các file cache JSON còn sót lại từ phiên bản cache một-file-mỗi-entry cũ.
         
         Args:
             older_than: Xóa các file cũ hơn số giây này (None = xóa tất cả)
@@ -111,26 +298,32 @@ class CacheManager:
         Returns:
             int: Số file đã xóa
         """
-        if not self.use_cache or not os.path.exists(self.cache_dir):
+        if not os.path.isdir(self.cache_dir):
             return 0
         
         deleted_count = 0
         current_time = time.time()
         
-        for filename in os.listdir(self.cache_dir):
-            if not filename.endswith('.json'):
-                continue
+        # DirEntry.stat() được cache nên mỗi file chỉ tốn tối đa một syscall stat
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
                 
-            file_path = os.path.join(self.cache_dir, filename)
-            file_time = os.path.getmtime(file_path)
-            
-            # Xóa tất cả hoặc chỉ các file cũ hơn older_than
-            if older_than is None or (current_time - file_time) > older_than:
                 try:
-                    os.remove(file_path)
-                    deleted_count += 1
-                except Exception as e:
-                    logging.warning(f"Không thể xóa cache file {filename}: {e}")
+                    if older_than is None or (current_time - entry.stat().st_mtime) > older_than:
+                        os.unlink(entry.path)
+                        deleted_count += 1
+                except OSError as e:
+                    logging.warning("Không thể xóa cache file %s: %s", entry.name, e)
         
-        logging.info(f"Đã xóa {deleted_count} cache files")
-        return deleted_count
\ No newline at end of file
+        return deleted_count
+    
+    def close(self):
+        """
+        Đóng kết nối đến database cache.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
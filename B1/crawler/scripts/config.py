@@ -8,6 +8,12 @@ import json
 from pathlib import Path
 from dotenv import load_dotenv
 
+
+def _to_bool(value):
+    """Chuyển chuỗi "true"/"false" từ biến môi trường thành bool"""
+    return value.lower() == "true"
+
+
 class Config:
     """Quản lý cấu hình từ file .env và cấu hình mặc định"""
     
@@ -15,6 +21,7 @@ class Config:
     DEFAULT_CONFIG = {
         # API Settings
         "tmdb_api_key": None,
+        "tmdb_access_token": None,  # API Read Access Token (Bearer), thay thế api_key
         "tmdb_base_url": "https://api.themoviedb.org/3",
         "tmdb_image_base_url": "https://image.tmdb.org/t/p/",
         "default_language": "vi-VN",
@@ -29,6 +36,7 @@ class Config:
         # Cache Settings
         "use_cache": True,
         "cache_ttl": 86400,  # 24 hours
+        "negative_cache_ttl": None,  # None = dùng cache_ttl
         
         # Data Sources
         "data_sources": {
@@ -37,14 +45,33 @@ class Config:
             "trending_day": {"enabled": True, "pages": 2},
             "trending_week": {"enabled": True, "pages": 2},
             "top_rated": {"enabled": True, "pages": 3},
+        },
         "batch_size": 25,
-        "max_workers": 5,
-        "max_retries": 3,
-        "retry_backoff": 1.5,
-        "rate_limit_wait": 0.25
-        }
+        "max_workers": 5
     }
     
+    # Ánh xạ biến môi trường -> (khóa cấu hình, hàm chuyển kiểu)
+    ENV_MAP = [
+        # API settings
+        ("TMDB_API_KEY", "tmdb_api_key", str),
+        ("TMDB_ACCESS_TOKEN", "tmdb_access_token", str),
+        ("TMDB_BASE_URL", "tmdb_base_url", str),
+        ("TMDB_IMAGE_BASE_URL", "tmdb_image_base_url", str),
+        ("DEFAULT_LANGUAGE", "default_language", str),
+        
+        # Crawler settings
+        ("CRAWLER_MAX_RETRIES", "crawler_max_retries", int),
+        ("CRAWLER_DELAY", "crawler_delay", float),
+        ("CRAWLER_TIMEOUT", "crawler_timeout", int),
+        ("MAX_PAGES_PER_SOURCE", "max_pages_per_source", int),
+        ("MAX_MOVIES_PER_DAY", "max_movies_per_day", int),
+        
+        # Cache settings
+        ("USE_CACHE", "use_cache", _to_bool),
+        ("CACHE_TTL", "cache_ttl", int),
+        ("NEGATIVE_CACHE_TTL", "negative_cache_ttl", int),
+    ]
+    
     def __init__(self, env_path=None):
         """
         Khởi tạo cấu hình từ .env
@@ -66,29 +93,11 @@ class Config:
     
     def _update_from_env(self):
         """Cập nhật cấu hình từ biến môi trường - Nguồn sự thật"""
-        # API settings
-        self.config["tmdb_api_key"] = os.getenv("TMDB_API_KEY", self.config["tmdb_api_key"])
-        self.config["tmdb_base_url"] = os.getenv("TMDB_BASE_URL", self.config["tmdb_base_url"])
-        self.config["tmdb_image_base_url"] = os.getenv("TMDB_IMAGE_BASE_URL", self.config["tmdb_image_base_url"])
-        self.config["default_language"] = os.getenv("DEFAULT_LANGUAGE", self.config["default_language"])
-        
-        # Crawler settings
-        if os.getenv("CRAWLER_MAX_RETRIES"):
-            self.config["crawler_max_retries"] = int(os.getenv("CRAWLER_MAX_RETRIES"))
-        if os.getenv("CRAWLER_DELAY"):
-            self.config["crawler_delay"] = float(os.getenv("CRAWLER_DELAY"))
-        if os.getenv("CRAWLER_TIMEOUT"):
-            self.config["crawler_timeout"] = int(os.getenv("CRAWLER_TIMEOUT"))
-        if os.getenv("MAX_PAGES_PER_SOURCE"):
-            self.config["max_pages_per_source"] = int(os.getenv("MAX_PAGES_PER_SOURCE"))
-        if os.getenv("MAX_MOVIES_PER_DAY"):
-            self.config["max_movies_per_day"] = int(os.getenv("MAX_MOVIES_PER_DAY"))
-            
-        # Cache settings
-        if os.getenv("USE_CACHE"):
-            self.config["use_cache"] = os.getenv("USE_CACHE").lower() == "true"
-        if os.getenv("CACHE_TTL"):
-            self.config["cache_ttl"] = int(os.getenv("CACHE_TTL"))
+        # Mỗi biến môi trường chỉ được đọc và chuyển kiểu một lần
+        for env_name, key, cast in self.ENV_MAP:
+            value = os.environ.get(env_name)
+            if value:
+                self.config[key] = cast(value)
         
         # Đường dẫn dữ liệu - LUÔN ưu tiên biến môi trường
         # Trong Docker, đường dẫn cố định
@@ -114,7 +123,8 @@ class Config:
             self.config["cache_dir"],
             self.config["logs_dir"]
         ]:
-            os.makedirs(directory, exist_ok=True)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
     
     def get(self, key, default=None):
         """Lấy giá trị cấu hình theo khóa"""
@@ -5,21 +5,40 @@ Crawler thu thập dữ liệu phim từ TMDB API
 
 import os
 import json
-import time
 import logging
 import argparse
+from collections import defaultdict
 from datetime import datetime
 from typing import Dict, List, Optional, Set, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import pandas as pd
 import hashlib
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
+
+try:
+    import orjson
+except ImportError:
+    # orjson là tùy chọn, dùng json chuẩn nếu chưa được cài
+    orjson = None
+
+# Logger của crawler, được cấu hình bởi setup_logging
+logger = logging.getLogger("netflix_crawler")
+
+
+def _json_line(data) -> bytes:
+    """Serialize một record thành một dòng NDJSON."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+    return json.dumps(data, ensure_ascii=False).encode('utf-8') + b"\n"
+
 # Thêm các import cần thiết
 try:
     # Import từ thư mục hiện tại khi chạy trực tiếp
     from config import Config
     from tmdb_client import TMDBClient
-    from cache_manager import CacheManager
 except ImportError:
     # Import đường dẫn tuyệt đối khi chạy trong Docker/Airflow
     import sys
@@ -27,7 +46,6 @@ except ImportError:
     sys.path.insert(0, script_dir)
     from config import Config
     from tmdb_client import TMDBClient
-    from cache_manager import CacheManager
 
 
 class NetflixDataCrawler:
@@ -35,6 +53,12 @@ class NetflixDataCrawler:
     Crawler chính để thu thập dữ liệu phim từ TMDB API.
     """
     
+    # Các loại danh sách phim được hỗ trợ
+    LIST_TYPES = ("popular", "top_rated", "now_playing", "netflix", "trending_day", "trending_week")
+    
+    # Các trường trong details được ghi thêm dưới dạng bảng (Parquet) cho bước phân tích
+    TABLE_FIELDS = ("title", "release_date", "popularity", "vote_average", "vote_count", "runtime")
+    
     def __init__(self, config=None):
         """
         Khởi tạo Netflix data crawler.
@@ -48,10 +72,8 @@ class NetflixDataCrawler:
         # Khởi tạo TMDB client
         self.tmdb = TMDBClient(self.config)
         
-        # Khởi tạo cache manager
-        cache_dir = self.config.get("cache_dir", "cache")
-        os.makedirs(cache_dir, exist_ok=True)
-        self.cache = CacheManager(cache_dir)
+        # Dùng chung cache manager (và kết nối SQLite) với TMDB client
+        self.cache = self.tmdb.cache
         
         # Đường dẫn thư mục dữ liệu
         self.raw_data_dir = self.config.get("raw_data_dir")
@@ -64,45 +86,28 @@ class NetflixDataCrawler:
         # Lấy các tham số cấu hình
         self.batch_size = self.config.get("batch_size", 25)
         self.max_workers = self.config.get("max_workers", 5)
-        self.max_retries = self.config.get("max_retries", 3)
-        self.retry_backoff = self.config.get("retry_backoff", 1.5)
-        self.rate_limit_wait = self.config.get("rate_limit_wait", 0.25)
         
-        logging.info(f"Netflix Data Crawler đã khởi tạo: raw_data_dir={self.raw_data_dir}")
+        # Movie ID -> {nguồn: trang đầu tiên chứa phim}, ghi nhận khi crawl danh sách
+        self._origins = defaultdict(dict)
+        # Movie ID -> popularity lấy từ danh sách, dùng để ưu tiên phim khi crawl chi tiết
+        self._popularity = {}
+        # Định dạng cache key của crawl_movie_details (giữ tiền tố cũ để cache hiện có vẫn dùng được)
+        self._key_fmt = "movie_details_{}".format
+        
+        logger.info("Netflix Data Crawler đã khởi tạo: raw_data_dir=%s", self.raw_data_dir)
     
-    def with_retry(self, func, *args, max_retries=None, backoff_factor=None, **kwargs):
+    def close(self):
         """
-        Thực hiện API call với cơ chế retry tự động
-        
-        Args:
-            func: Phương thức API cần gọi
-            max_retries: Số lần thử lại tối đa (None = dùng cấu hình)
-            backoff_factor: Hệ số tăng thời gian chờ (None = dùng cấu hình)
-            
-        Returns:
-            Kết quả từ API call hoặc None nếu tất cả các lần thử đều thất bại
+        Giải phóng HTTP session và kết nối cache của TMDB client.
         """
-        if max_retries is None:
-            max_retries = self.max_retries
-            
-        if backoff_factor is None:
-            backoff_factor = self.retry_backoff
-            
-        retries = 0
-        last_exception = None
-        
-        while retries < max_retries:
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                last_exception = e
-                wait_time = backoff_factor * (2 ** retries)
-                logging.warning(f"API call failed: {e}. Retrying in {wait_time:.1f}s ({retries+1}/{max_retries})")
-                time.sleep(wait_time)
-                retries += 1
-        
-        logging.error(f"API call failed after {max_retries} retries: {last_exception}")
-        return None
+        self.tmdb.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
     
     def crawl_movie_list(self, list_type: str, num_pages: int = 5) -> List[Dict]:
         """
@@ -115,64 +120,99 @@ class NetflixDataCrawler:
         Returns:
             List[Dict]: Danh sách phim đã crawl
         """
-        logging.info(f"Crawling {list_type} movies - {num_pages} pages")
+        logger.info("Crawling %s movies - %d pages", list_type, num_pages)
         
-        all_movies = []
+        if list_type not in self.LIST_TYPES:
+            logger.warning("Unknown list type: %s", list_type)
+            return []
         
-        for page in range(1, num_pages + 1):
-            logging.info(f"Crawling {list_type} page {page}/{num_pages}")
-            
-            if list_type == "popular":
-                movies = self.with_retry(self.tmdb.get_popular_movies, page)
-            elif list_type == "top_rated":
-                movies = self.with_retry(self.tmdb.get_top_rated_movies, page)
-            elif list_type == "now_playing":
-                movies = self.with_retry(self.tmdb.get_now_playing_movies, page)
-            elif list_type == "netflix":
-                movies = self.with_retry(self.tmdb.get_netflix_movies, page)
-            elif list_type == "trending_day":
-                movies = self.with_retry(self.tmdb.get_trending_movies, "day", page)
-            elif list_type == "trending_week":
-                movies = self.with_retry(self.tmdb.get_trending_movies, "week", page)
-            else:
-                logging.warning(f"Unknown list type: {list_type}")
-                continue
+        if num_pages < 1:
+            return []
+        
+        # Các trang được lấy song song; TMDBClient tự giới hạn tốc độ bằng token bucket
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, num_pages)) as executor:
+            pages = executor.map(lambda page: self._fetch_list_page(list_type, page),
+                                 range(1, num_pages + 1))
+            return self._merge_list_pages(list_type, num_pages, pages)
+    
+    def _merge_list_pages(self, list_type: str, num_pages: int, pages) -> List[Dict]:
+        """
+        Gộp kết quả các trang của một danh sách phim theo thứ tự trang.
+        
+        Args:
+            list_type: Loại danh sách phim
+            num_pages: Số trang
+            pages: Iterable API response của từng trang (theo thứ tự trang)
             
+        Returns:
+            List[Dict]: Danh sách phim của tất cả các trang
+        """
+        all_movies = []
+        for page, movies in enumerate(pages, 1):
             if movies and 'results' in movies:
+                # Ghi nguồn/trang vào index riêng thay vì sửa dict của response
+                # (response có thể là object dùng chung trong cache bộ nhớ)
                 for movie in movies['results']:
-                    movie['source_list'] = list_type
-                    movie['page'] = page
+                    self._origins[movie['id']].setdefault(list_type, page)
+                    self._popularity[movie['id']] = movie.get('popularity') or 0
                 all_movies.extend(movies['results'])
-                logging.info(f"Found {len(movies['results'])} movies")
-            
-            time.sleep(self.rate_limit_wait)  # Rate limiting
+                logger.info("Found %d movies on %s page %d/%d", len(movies['results']), list_type, page, num_pages)
         
-        logging.info(f"Total {list_type} movies: {len(all_movies)}")
+        logger.info("Total %s movies: %d", list_type, len(all_movies))
         return all_movies
     
-    def crawl_movie_details(self, movie_id: int) -> Dict:
+    def _fetch_list_page(self, list_type: str, page: int) -> Optional[Dict]:
+        """
+        Lấy một trang của danh sách phim.
+        
+        Args:
+            list_type: Loại danh sách phim (xem LIST_TYPES)
+            page: Số trang
+            
+        Returns:
+            Dict: API response của trang hoặc None nếu thất bại
+        """
+        logger.debug("Crawling %s page %d", list_type, page)
+        
+        if list_type == "popular":
+            return self.tmdb.get_popular_movies(page)
+        elif list_type == "top_rated":
+            return self.tmdb.get_top_rated_movies(page)
+        elif list_type == "now_playing":
+            return self.tmdb.get_now_playing_movies(page)
+        elif list_type == "netflix":
+            return self.tmdb.get_netflix_movies(page)
+        elif list_type == "trending_day":
+            return self.tmdb.get_trending_movies("day", page)
+        elif list_type == "trending_week":
+            return self.tmdb.get_trending_movies("week", page)
+        return None
+    
+    def crawl_movie_details(self, movie_id: int, crawl_ts: Optional[str] = None) -> Dict:
         """
         Crawl thông tin chi tiết của một phim với cache.
         
         Args:
             movie_id: ID của phim
+            crawl_ts: Thời điểm crawl (ISO) dùng chung cho cả lượt crawl (None = thời điểm hiện tại)
             
         Returns:
             Dict: Thông tin chi tiết của phim
         """
-        logging.info(f"Crawling details for movie ID: {movie_id}")
+        logger.debug("Crawling details for movie ID: %s", movie_id)
         
         # Kiểm tra cache
-        cache_key = f"movie_details_{movie_id}"
+        cache_key = self._key_fmt(movie_id)
         cached_data = self.cache.get(cache_key)
         
         if cached_data:
-            logging.info(f"Using cached data for movie ID: {movie_id}")
-            return cached_data
+            logger.debug("Using cached data for movie ID: %s", movie_id)
+            # Bản sao với thời điểm của lượt crawl hiện tại (không sửa record trong cache)
+            return {**cached_data, 'crawl_timestamp': crawl_ts or datetime.now().isoformat()}
         
         movie_data = {
             'movie_id': movie_id,
-            'crawl_timestamp': datetime.now().isoformat(),
+            'crawl_timestamp': crawl_ts or datetime.now().isoformat(),
             'details': None,
             'credits': None,
             'keywords': None,
@@ -181,83 +221,103 @@ class NetflixDataCrawler:
             'similar': None
         }
         
+        # Lấy tất cả dữ liệu của phim trong một request (append_to_response)
+        bundle = self.tmdb.fetch_movie_bundle(movie_id) or {}
+        
         # 1. Movie details
-        movie_details = self.with_retry(self.tmdb.get_movie_details, movie_id)
+        movie_details = bundle.get('details')
         if movie_details:
             movie_data['details'] = movie_details
-            logging.info(f"✓ Details: {movie_details.get('title', 'N/A')}")
+            logger.debug("✓ Details: %s", movie_details.get('title', 'N/A'))
         else:
-            logging.warning(f"✗ No details found for movie ID: {movie_id}")
+            logger.warning("✗ No details found for movie ID: %s", movie_id)
             return movie_data  # Return early if we can't get basic details
         
-        # 2. Credits (cast & crew)
-        credits = self.with_retry(self.tmdb.get_movie_credits, movie_id)
-        if credits:
-            movie_data['credits'] = credits
-            cast_count = len(credits.get('cast', []))
-            crew_count = len(credits.get('crew', []))
-            logging.info(f"✓ Credits: {cast_count} cast, {crew_count} crew")
-        
-        # 3. Keywords
-        keywords = self.with_retry(self.tmdb.get_movie_keywords, movie_id)
-        if keywords:
-            movie_data['keywords'] = keywords
-            keyword_count = len(keywords.get('keywords', []))
-            logging.info(f"✓ Keywords: {keyword_count} keywords")
-        
-        # 4. Videos/Trailers
-        videos = self.with_retry(self.tmdb.get_movie_videos, movie_id)
-        if videos:
-            movie_data['videos'] = videos
-            video_count = len(videos.get('results', []))
-            logging.info(f"✓ Videos: {video_count} videos")
-        
-        # 5. Reviews
-        reviews = self.with_retry(self.tmdb.get_movie_reviews, movie_id)
-        if reviews:
-            movie_data['reviews'] = reviews
-            review_count = len(reviews.get('results', []))
-            logging.info(f"✓ Reviews: {review_count} reviews")
-        
-        # 6. Similar movies
-        similar = self.with_retry(self.tmdb.get_movie_similar, movie_id)
-        if similar:
-            movie_data['similar'] = similar
-            similar_count = len(similar.get('results', []))
-            logging.info(f"✓ Similar: {similar_count} similar movies")
+        # 2-6. Credits, keywords, videos, reviews, similar
+        for part in ('credits', 'keywords', 'videos', 'reviews', 'similar'):
+            if bundle.get(part):
+                movie_data[part] = bundle[part]
+        
+        # Thống kê từng phần chỉ được tính khi log DEBUG được bật
+        if logger.isEnabledFor(logging.DEBUG):
+            credits = movie_data['credits'] or {}
+            if credits:
+                logger.debug("✓ Credits: %d cast, %d crew",
+                             len(credits.get('cast', [])), len(credits.get('crew', [])))
+            if movie_data['keywords']:
+                logger.debug("✓ Keywords: %d keywords", len(movie_data['keywords'].get('keywords', [])))
+            if movie_data['videos']:
+                logger.debug("✓ Videos: %d videos", len(movie_data['videos'].get('results', [])))
+            if movie_data['reviews']:
+                logger.debug("✓ Reviews: %d reviews", len(movie_data['reviews'].get('results', [])))
+            if movie_data['similar']:
+                logger.debug("✓ Similar: %d similar movies", len(movie_data['similar'].get('results', [])))
         
         # Lưu vào cache nếu có dữ liệu cơ bản
         if movie_data['details']:
-            self.cache.set(cache_key, movie_data)
+            self.cache.set(cache_key, None, movie_data)
         
         return movie_data
     
-    def save_movie_batch(self, movies, timestamp, batch_index):
+    def collect_movie_sources(self, sources: List[str], num_pages_per_source: int) -> Dict[int, List[str]]:
         """
-        Lưu một batch phim vào file riêng biệt
+        Thu thập movie IDs từ các nguồn và ghi nhận nguồn của từng phim.
         
         Args:
-            movies: Danh sách phim cần lưu
-            timestamp: Timestamp cho tên file
-            batch_index: Chỉ số batch
+            sources: Danh sách nguồn để crawl
+            num_pages_per_source: Số trang mỗi nguồn (nếu nguồn không có cấu hình riêng)
             
         Returns:
-            str: Đường dẫn đến file đã lưu
+            Dict[int, List[str]]: Movie ID -> danh sách nguồn chứa phim đó
         """
-        if not movies:
-            return None
+        # Dùng set để mỗi nguồn chỉ được ghi nhận một lần cho mỗi phim,
+        # kể cả khi phim xuất hiện ở nhiều trang của cùng nguồn
+        movie_sources = defaultdict(set)
+        
+        # Đọc cấu hình nguồn một lần thay vì tra cứu lại trong mỗi vòng lặp
+        data_sources = self.config.get("data_sources", {}) or {}
+        
+        source_pages = {}
+        for source in sources:
+            if source not in self.LIST_TYPES:
+                logger.warning("Unknown list type: %s", source)
+                continue
+            # Điều chỉnh số trang theo cấu hình nguồn cụ thể nếu có
+            source_pages[source] = data_sources.get(source, {}).get("pages", num_pages_per_source)
+        
+        if not source_pages:
+            return {}
+        
+        # Mọi trang của mọi nguồn dùng chung một pool max_workers thread, để số
+        # request đồng thời không vượt quá connection pool của TMDBClient.
+        # Kết quả được gộp tuần tự theo thứ tự nguồn.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            page_futures = {
+                source: [executor.submit(self._fetch_list_page, source, page) for page in range(1, num_pages + 1)]
+                for source, num_pages in source_pages.items()
+            }
             
-        batch_file = os.path.join(self.raw_data_dir, 
-                                  f"detailed_movies_batch_{batch_index}_{timestamp}.json")
-        self.save_json(movies, batch_file)
-        logging.info(f"Saved batch {batch_index}: {len(movies)} movies")
-        return batch_file
+            for source, futures in page_futures.items():
+                logger.info("Crawling %s movies - %d pages", source, len(futures))
+                try:
+                    movies = self._merge_list_pages(source, len(futures), (future.result() for future in futures))
+                except Exception as e:
+                    logger.error("Error crawling %s: %s", source, e)
+                    continue
+                
+                for movie in movies:
+                    movie_sources[movie['id']].add(source)
+        
+        # Chuyển về list đã sắp xếp để serialize JSON ổn định
+        return {movie_id: sorted(found_in) for movie_id, found_in in movie_sources.items()}
     
     def crawl_daily_netflix_data(self, 
                                 num_pages_per_source: int = None,
                                 max_movies: int = None,
                                 sources: List[str] = None,
-                                resume_from: str = None) -> Dict:
+                                resume_from: str = None,
+                                movie_sources: Dict[int, List[str]] = None,
+                                popularity: Dict[int, float] = None) -> Dict:
         """
         Crawl dữ liệu hàng ngày từ nhiều nguồn.
         
@@ -266,6 +326,8 @@ class NetflixDataCrawler:
             max_movies: Số phim tối đa để crawl chi tiết (None = dùng cấu hình)
             sources: Danh sách nguồn để crawl (None = dùng tất cả nguồn được bật trong cấu hình)
             resume_from: Đường dẫn file lưu danh sách movie_ids đã thất bại để thử lại
+            movie_sources: Movie ID -> danh sách nguồn đã thu thập sẵn (None = tự crawl các nguồn)
+            popularity: Movie ID -> popularity của các phim thu thập sẵn (None = dùng dữ liệu đã crawl)
             
         Returns:
             Dict: Kết quả crawl với summary và danh sách phim
@@ -279,19 +341,21 @@ class NetflixDataCrawler:
         
         # Nếu không chỉ định nguồn, sử dụng tất cả nguồn được bật trong cấu hình
         if sources is None:
-            sources = []
-            data_sources = self.config.get("data_sources", {})
-            for source, config in data_sources.items():
-                if config.get("enabled", True):
-                    sources.append(source)
+            data_sources = self.config.get("data_sources", {}) or {}
+            sources = [
+                source for source, source_cfg in data_sources.items()
+                if source_cfg.get("enabled", True)
+            ]
                     
-        logging.info(f"Starting daily Netflix data crawl:")
-        logging.info(f"- Sources: {sources}")
-        logging.info(f"- Pages per source: {num_pages_per_source}")
-        logging.info(f"- Max movies for detailed crawl: {max_movies}")
+        logger.info("Starting daily Netflix data crawl:")
+        logger.info("- Sources: %s", sources)
+        logger.info("- Pages per source: %s", num_pages_per_source)
+        logger.info("- Max movies for detailed crawl: %s", max_movies)
         
-        # Tạo timestamp cho tên file
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Tạo timestamp cho tên file và thời điểm crawl dùng chung cho mọi phim
+        crawl_start = datetime.now()
+        timestamp = crawl_start.strftime('%Y%m%d_%H%M%S')
+        crawl_ts = crawl_start.isoformat()
         
         # Nếu là chế độ tiếp tục, load movie IDs đã thất bại
         selected_movies = []
@@ -300,104 +364,106 @@ class NetflixDataCrawler:
                 with open(resume_from, 'r') as f:
                     failed_data = json.load(f)
                     selected_movies = failed_data.get('failed_movie_ids', [])
-                    logging.info(f"Resuming crawl for {len(selected_movies)} previously failed movies")
+                    logger.info("Resuming crawl for %d previously failed movies", len(selected_movies))
             except Exception as e:
-                logging.error(f"Error loading resume file {resume_from}: {e}")
+                logger.error("Error loading resume file %s: %s", resume_from, e)
                 # Tiếp tục với quy trình bình thường
                 selected_movies = []
         
         # Nếu không phải chế độ resume hoặc resume thất bại, thu thập movie IDs mới
         if not selected_movies:
-            # 1. Thu thập movie IDs từ các nguồn khác nhau
-            all_movie_ids = set()
-            movie_sources = {}
+            # 1. Thu thập movie IDs từ các nguồn khác nhau (nếu chưa được thu thập sẵn)
+            if movie_sources is None:
+                movie_sources = self.collect_movie_sources(sources, num_pages_per_source)
             
-            for source in sources:
-                try:
-                    # Điều chỉnh số trang theo cấu hình nguồn cụ thể nếu có
-                    source_pages = self.config.get_nested("data_sources", source, "pages", default=num_pages_per_source)
-                    movies = self.crawl_movie_list(source, source_pages)
-                    
-                    for movie in movies:
-                        movie_id = movie['id']
-                        all_movie_ids.add(movie_id)
-                        
-                        if movie_id not in movie_sources:
-                            movie_sources[movie_id] = []
-                        movie_sources[movie_id].append(source)
-                        
-                except Exception as e:
-                    logging.error(f"Error crawling {source}: {e}")
-                    continue
-            
-            logging.info(f"Collected {len(all_movie_ids)} unique movies from {len(sources)} sources")
+            logger.info("Collected %d unique movies from %d sources", len(movie_sources), len(sources))
             
             # 2. Lưu summary danh sách phim
             movie_list_summary = {
                 'crawl_date': datetime.now().isoformat(),
-                'total_unique_movies': len(all_movie_ids),
+                'total_unique_movies': len(movie_sources),
                 'sources': sources,
                 'pages_per_source': num_pages_per_source,
                 'movie_sources': movie_sources
             }
+            if self._origins:
+                # Trang đầu tiên chứa phim trong từng nguồn
+                movie_list_summary['movie_origins'] = self._origins
             
             summary_file = os.path.join(self.raw_data_dir, f"movie_list_summary_{timestamp}.json")
-            self.save_json(movie_list_summary, summary_file)
+            # Summary chứa toàn bộ movie_sources nên ghi gọn
+            self.save_json(movie_list_summary, summary_file, indent=False)
             
-            # Giới hạn số lượng phim để crawl chi tiết
-            selected_movies = list(all_movie_ids)[:max_movies]
-        
-        logging.info(f"Crawling detailed info for {len(selected_movies)} movies...")
+            # Giới hạn số lượng phim để crawl chi tiết, ưu tiên phim phổ biến hơn
+            if popularity is None:
+                popularity = self._popularity
+            selected_movies = sorted(movie_sources, key=lambda movie_id: -popularity.get(movie_id, 0))[:max_movies]
         
-        # Khởi tạo file dataset cho toàn bộ kết quả
-        dataset_header = {
-            'crawl_summary': {
-                'crawl_date': datetime.now().isoformat(),
-                'crawl_timestamp': timestamp,
-                'total_movies_attempted': len(selected_movies),
-                'sources': sources if not resume_from else "resume"
-            },
-            'movies': []
-        }
+        logger.info("Crawling detailed info for %d movies...", len(selected_movies))
         
+        # File dataset chỉ chứa summary, được ghi một lần khi crawl xong để
+        # load_latest_raw_data không đọc phải dataset đang crawl dở
         final_file = os.path.join(self.raw_data_dir, f"netflix_raw_dataset_{timestamp}.json")
-        self.save_json(dataset_header, final_file)
         
-        detailed_movies = []
-        failed_movies = []
-        batch_buffer = []
+        # Mỗi phim được ghi thành một dòng NDJSON ngay khi crawl xong
+        movies_file = os.path.join(self.raw_data_dir, f"netflix_raw_movies_{timestamp}.ndjson")
+        
+        successful_count = 0
+        failed_movies = set()
+        
+        # Buffer dạng cột cho các trường chính, mỗi cột là một list
+        columns = defaultdict(list)
         
         # 3. Crawl thông tin chi tiết với xử lý song song
-        max_workers = min(self.max_workers, len(selected_movies))
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks
-            future_to_id = {executor.submit(self.crawl_movie_details, movie_id): movie_id for movie_id in selected_movies}
+        max_workers = max(1, min(self.max_workers, len(selected_movies)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, open(movies_file, 'wb', buffering=1 << 20) as movies_out:
+            # Gán các thuộc tính dùng trong vòng lặp vào biến cục bộ
+            crawl_details = self.crawl_movie_details
+            write_line = movies_out.write
+            batch_size = self.batch_size
+            total_movies = len(selected_movies)
             
-            # Process results as they complete
-            for i, future in enumerate(as_completed(future_to_id), 1):
-                movie_id = future_to_id[future]
-                try:
-                    movie_data = future.result()
-                    
-                    if movie_data['details']:  # Only save if we got basic details
-                        if not resume_from:  # Nếu không phải resume, thêm thông tin nguồn
-                            movie_data['sources'] = movie_sources.get(movie_id, [])
-                        detailed_movies.append(movie_data)
-                        batch_buffer.append(movie_data)
-                    else:
-                        if movie_id not in failed_movies:  # Tránh thêm trùng lặp
-                            failed_movies.append(movie_id)
-                    
-                    # Progress save every batch_size movies
-                    if len(batch_buffer) >= self.batch_size or i == len(selected_movies):
-                        batch_file = self.save_movie_batch(batch_buffer, timestamp, i // self.batch_size)
-                        batch_buffer = []  # Reset buffer
+            # Chỉ giữ tối đa 2 * max_workers future đang chạy, submit thêm khi có future hoàn thành
+            pending_ids = iter(selected_movies)
+            future_to_id = {
+                executor.submit(crawl_details, movie_id, crawl_ts): movie_id
+                for movie_id in islice(pending_ids, 2 * max_workers)
+            }
+            
+            i = 0
+            while future_to_id:
+                done, _ = wait(future_to_id, return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    movie_id = future_to_id.pop(future)
+                    i += 1
+                    try:
+                        movie_data = future.result()
                         
-                except Exception as e:
-                    logging.error(f"Error crawling movie {movie_id}: {e}")
-                    if movie_id not in failed_movies:  # Tránh thêm trùng lặp
-                        failed_movies.append(movie_id)
-                    continue
+                        if movie_data['details']:  # Only save if we got basic details
+                            if not resume_from:  # Nếu không phải resume, thêm thông tin nguồn
+                                # Tạo dict mới: movie_data có thể là object trong cache bộ nhớ
+                                movie_data = {**movie_data, 'sources': movie_sources.get(movie_id, [])}
+                            write_line(_json_line(movie_data))
+                            self._append_columns(columns, movie_data)
+                            successful_count += 1
+                        else:
+                            failed_movies.add(movie_id)
+                        
+                        # Mỗi batch_size phim: đẩy buffer xuống đĩa để crawl bị ngắt
+                        # giữa chừng vẫn giữ được các phim đã ghi
+                        if i % batch_size == 0:
+                            movies_out.flush()
+                            os.fsync(movies_out.fileno())
+                            logger.info("Progress: %d/%d movies, %d saved", i, total_movies, successful_count)
+                            
+                    except Exception as e:
+                        logger.error("Error crawling movie %s: %s", movie_id, e)
+                        failed_movies.add(movie_id)
+                
+                # Bổ sung future mới thay cho các future vừa hoàn thành
+                for movie_id in islice(pending_ids, len(done)):
+                    future_to_id[executor.submit(crawl_details, movie_id, crawl_ts)] = movie_id
         
         # 4. Lưu kết quả cuối cùng
         final_results = {
@@ -405,35 +471,112 @@ class NetflixDataCrawler:
                 'crawl_date': datetime.now().isoformat(),
                 'crawl_timestamp': timestamp,
                 'total_movies_attempted': len(selected_movies),
-                'successful_crawls': len(detailed_movies),
+                'sources': sources if not resume_from else "resume",
+                'successful_crawls': successful_count,
                 'failed_crawls': len(failed_movies),
-                'failed_movie_ids': failed_movies
+                'failed_movie_ids': sorted(failed_movies)
             },
-            'movies': detailed_movies
+            'movies_file': os.path.basename(movies_file)
         }
         
+        table_file = os.path.join(self.raw_data_dir, f"netflix_movies_{timestamp}.parquet")
+        if columns and self.save_parquet(columns, table_file):
+            final_results['table_file'] = os.path.basename(table_file)
+        
         self.save_json(final_results, final_file)
         
         # Lưu riêng danh sách phim thất bại để có thể retry sau
         if failed_movies:
             failed_file = os.path.join(self.raw_data_dir, f"failed_movies_{timestamp}.json")
-            self.save_json({'failed_movie_ids': failed_movies}, failed_file)
-            logging.info(f"Saved {len(failed_movies)} failed movie IDs to {failed_file}")
+            self.save_json({'failed_movie_ids': final_results['crawl_summary']['failed_movie_ids']}, failed_file)
+            logger.info("Saved %d failed movie IDs to %s", len(failed_movies), failed_file)
         
-        logging.info(f"CRAWL COMPLETED!")
-        logging.info(f"- Successfully crawled: {len(detailed_movies)} movies")
-        logging.info(f"- Failed: {len(failed_movies)} movies")
-        logging.info(f"- Saved to: {final_file}")
+        logger.info("CRAWL COMPLETED!")
+        logger.info("- Successfully crawled: %d movies", successful_count)
+        logger.info("- Failed: %d movies", len(failed_movies))
+        logger.info("- Saved to: %s (movies: %s)", final_file, movies_file)
         
         return final_results
     
-    def save_json(self, data, filepath):
+    def _append_columns(self, columns, movie_data):
+        """
+        Thêm các trường chính của một phim vào buffer dạng cột.
+        
+        Args:
+            columns: Tên cột -> list giá trị
+            movie_data: Dữ liệu phim từ crawl_movie_details
+        """
+        details = movie_data['details']
+        columns['movie_id'].append(movie_data['movie_id'])
+        for field in self.TABLE_FIELDS:
+            columns[field].append(details.get(field))
+        columns['genres'].append([genre.get('name') for genre in details.get('genres') or []])
+        columns['sources'].append(movie_data.get('sources', []))
+    
+    def save_parquet(self, columns, filepath):
+        """
+        Lưu buffer dạng cột vào file Parquet (cần pyarrow).
+        
+        Args:
+            columns: Tên cột -> list giá trị
+            filepath: Đường dẫn file để lưu
+            
+        Returns:
+            bool: True nếu thành công, False nếu thất bại hoặc thiếu pyarrow
+        """
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logger.warning("pyarrow chưa được cài, bỏ qua file Parquet %s", filepath)
+            return False
+        
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        try:
+            pd.DataFrame(columns).to_parquet(tmp_path, engine="pyarrow", index=False)
+            os.replace(tmp_path, filepath)
+            logger.info("Saved to %s (%d bytes)", filepath, os.path.getsize(filepath))
+            return True
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            logger.error("Error saving %s: %s", filepath, e)
+            return False
+    
+    def to_dataframe(self, movies):
+        """
+        Chuyển details của các phim thành DataFrame phẳng (một cấp lồng nhau).
+        
+        Args:
+            movies: Iterable các record phim (vd. iter_latest_movies())
+            
+        Returns:
+            pd.DataFrame: Mỗi dòng là details của một phim, kèm cột movie_id
+        """
+        records = []
+        movie_ids = []
+        for movie in movies:
+            if movie.get('details'):
+                records.append(movie['details'])
+                movie_ids.append(movie['movie_id'])
+        
+        df = pd.json_normalize(records, max_level=1)
+        df.insert(0, 'movie_id', movie_ids)
+        
+        # Dùng dtype của pyarrow nếu có để giảm bộ nhớ cho cột chuỗi
+        try:
+            import pyarrow  # noqa: F401
+            return df.convert_dtypes(dtype_backend="pyarrow")
+        except ImportError:
+            return df.convert_dtypes()
+    
+    def save_json(self, data, filepath, indent=True):
         """
         Lưu dữ liệu vào file JSON với xử lý lỗi.
         
         Args:
             data: Dữ liệu để lưu
             filepath: Đường dẫn file để lưu
+            indent: Ghi thụt lề cho dễ đọc (False = ghi gọn, dùng cho file dữ liệu lớn)
             
         Returns:
             bool: True nếu thành công, False nếu thất bại
@@ -442,56 +585,160 @@ class NetflixDataCrawler:
             # Đảm bảo thư mục tồn tại
             os.makedirs(os.path.dirname(filepath), exist_ok=True)
             
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            # Ghi ra file tạm rồi đổi tên để không bao giờ để lại file bị cắt dở
+            tmp_path = f"{filepath}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    if orjson is not None:
+                        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+                        f.write(orjson.dumps(data, option=option))
+                    else:
+                        f.write(json.dumps(data, ensure_ascii=False, indent=2 if indent else None).encode('utf-8'))
+                os.replace(tmp_path, filepath)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
             
             # Lấy kích thước file
             file_size = os.path.getsize(filepath)
-            logging.info(f"Saved to {filepath} ({file_size:,} bytes)")
+            logger.info("Saved to %s (%d bytes)", filepath, file_size)
             return True
             
         except Exception as e:
-            logging.error(f"Error saving {filepath}: {e}")
+            logger.error("Error saving %s: %s", filepath, e)
             return False
     
-    def load_latest_raw_data(self):
+    def _find_latest_raw_file(self):
         """
-        Load file raw data mới nhất.
+        Tìm file raw dataset mới nhất.
         
         Returns:
-            Dict: Dữ liệu từ file mới nhất hoặc None nếu không tìm thấy
+            str: Đường dẫn file mới nhất hoặc None nếu không tìm thấy
         """
         if not os.path.exists(self.raw_data_dir):
-            logging.error(f"Raw data directory not found: {self.raw_data_dir}")
+            logger.error("Raw data directory not found: %s", self.raw_data_dir)
             return None
         
-        # Tìm file mới nhất
-        raw_files = []
-        for filename in os.listdir(self.raw_data_dir):
-            if filename.startswith("netflix_raw_dataset_") and filename.endswith(".json"):
-                filepath = os.path.join(self.raw_data_dir, filename)
-                creation_time = os.path.getctime(filepath)
-                raw_files.append((creation_time, filepath))
+        # Tìm file mới nhất: tên file chứa timestamp %Y%m%d_%H%M%S nên
+        # so sánh chuỗi là đủ, không cần stat từng file
+        with os.scandir(self.raw_data_dir) as entries:
+            raw_files = [
+                entry.name for entry in entries
+                if entry.name.startswith("netflix_raw_dataset_") and entry.name.endswith(".json")
+            ]
         
         if not raw_files:
-            logging.warning("No raw dataset files found")
+            logger.warning("No raw dataset files found")
             return None
         
-        # Load file mới nhất
-        latest_file = max(raw_files, key=lambda x: x[0])[1]
-        logging.info(f"Loading latest raw data: {latest_file}")
+        return os.path.join(self.raw_data_dir, max(raw_files))
+    
+    def _read_json_file(self, filepath):
+        """
+        Đọc một file JSON nhỏ (header/summary của dataset).
+        
+        Args:
+            filepath (str): Đường dẫn file
+            
+        Returns:
+            Dict: Dữ liệu JSON
+        """
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        return orjson.loads(content) if orjson is not None else json.loads(content)
+    
+    def _iter_movies_file(self, movies_file):
+        """
+        Đọc file NDJSON phim theo từng dòng.
+        
+        Args:
+            movies_file (str): Tên file NDJSON trong thư mục raw
+            
+        Yields:
+            Dict: Dữ liệu một phim
+        """
+        movies_path = os.path.join(self.raw_data_dir, movies_file)
+        with open(movies_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line) if orjson is not None else json.loads(line)
+    
+    def iter_latest_movies(self):
+        """
+        Duyệt lần lượt từng phim của dataset mới nhất mà không load toàn bộ
+        vào bộ nhớ. Nên dùng thay cho load_latest_raw_data với dataset lớn.
+        
+        Yields:
+            Dict: Dữ liệu một phim
+        """
+        latest_file = self._find_latest_raw_file()
+        if latest_file is None:
+            return
+        
+        logger.info("Streaming movies from latest raw data: %s", latest_file)
+        data = self._read_json_file(latest_file)
+        
+        if data.get('movies_file'):
+            yield from self._iter_movies_file(data['movies_file'])
+        else:
+            # File cũ lưu phim trực tiếp trong dataset
+            yield from data.get('movies', [])
+    
+    def load_latest_raw_data(self):
+        """
+        Load file raw data mới nhất, bao gồm toàn bộ danh sách phim.
+        Với dataset lớn, dùng iter_latest_movies để đọc từng phim.
+        
+        Returns:
+            Dict: Dữ liệu từ file mới nhất hoặc None nếu không tìm thấy
+        """
+        latest_file = self._find_latest_raw_file()
+        if latest_file is None:
+            return None
+        
+        logger.info("Loading latest raw data: %s", latest_file)
         
         try:
-            with open(latest_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = self._read_json_file(latest_file)
             
-            logging.info(f"Loaded {len(data.get('movies', []))} movies")
+            # Phim được lưu riêng trong file NDJSON được tham chiếu bởi movies_file
+            if 'movies' not in data and data.get('movies_file'):
+                data['movies'] = list(self._iter_movies_file(data['movies_file']))
+            
+            logger.info("Loaded %d movies", len(data.get('movies', [])))
             return data
             
         except Exception as e:
-            logging.error(f"Error loading {latest_file}: {e}")
+            logger.error("Error loading %s: %s", latest_file, e)
             return None
 
+# Listener ghi log ra file/console ở thread nền, một listener cho mỗi process
+_log_listener = None
+# QueueHandler gắn vào logger "netflix_crawler" tương ứng với listener trên
+_log_queue_handler = None
+
+
+def stop_logging():
+    """
+    Dừng listener hiện tại, ghi nốt các log còn trong queue và đóng handler.
+    Cần gọi khi kết thúc task: atexit không chạy khi process thoát bằng os._exit()
+    (vd. task runner của Airflow).
+    """
+    global _log_listener, _log_queue_handler
+    # Gỡ QueueHandler trước để không còn record nào vào queue không ai đọc
+    if _log_queue_handler is not None:
+        logger.removeHandler(_log_queue_handler)
+        _log_queue_handler = None
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+atexit.register(stop_logging)
+
 
 def setup_logging(log_dir=None, log_level=logging.INFO):
     """
@@ -500,7 +747,7 @@ def setup_logging(log_dir=None, log_level=logging.INFO):
         log_dir: Folder to store log file
         log_level: Logging level
     Returns:
-        logger: Configured logger
+        logger: Configured logger (gọi stop_logging() khi kết thúc để ghi nốt log)
     """
     if log_dir is None:
         log_dir = os.environ.get("LOGS_DIR", "logs")
@@ -515,6 +762,7 @@ def setup_logging(log_dir=None, log_level=logging.INFO):
     logger.propagate = False  # ⛔ Không lan lên root (Airflow logger)
 
     # 🧹 Xóa handler cũ nếu có
+    stop_logging()
     if logger.handlers:
         logger.handlers.clear()
 
@@ -524,16 +772,25 @@ def setup_logging(log_dir=None, log_level=logging.INFO):
     )
     file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
+    handlers = [file_handler]
 
     # Console handler (tuỳ chọn, có thể tắt nếu chạy trong Airflow)
     if os.environ.get("DOCKER_ENV", "").lower() != "true":
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(file_formatter)
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
+
+    # Các thread crawl chỉ đưa record vào queue, việc ghi file/console do
+    # listener chạy ở thread nền đảm nhiệm
+    global _log_listener, _log_queue_handler
+    log_queue = queue.Queue(-1)
+    _log_queue_handler = QueueHandler(log_queue)
+    logger.addHandler(_log_queue_handler)
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
 
     # 🛑 Không dùng logging.info(...) ở đây — thay vào đó:
-    logger.info(f"✅ Logging configured. File: {log_file}")
+    logger.info("✅ Logging configured. File: %s", log_file)
     return logger
 
 
@@ -556,38 +813,43 @@ def main():
     log_level = getattr(logging, args.log_level)
     setup_logging(log_dir=args.log_dir, log_level=log_level)
     
-    logging.info("=== NETFLIX CRAWLER STARTING ===")
-    
-    # Load configuration
     try:
-        config = Config()
-        logging.info(f"Configuration loaded successfully")
-    except Exception as e:
-        logging.error(f"Error loading configuration: {e}")
-        return
-    
-    # Create crawler
-    try:
-        crawler = NetflixDataCrawler(config)
-        logging.info("Netflix crawler initialized")
-    except Exception as e:
-        logging.error(f"Error initializing crawler: {e}")
-        return
-    
-    # Run daily crawl
-    try:
-        crawler.crawl_daily_netflix_data(
-            num_pages_per_source=args.pages,
-            max_movies=args.max_movies,
-            sources=args.sources,
-            resume_from=args.resume
-        )
-        logging.info("Crawling completed successfully")
-    except Exception as e:
-        logging.error(f"Error during crawling: {e}")
-        return
-    
-    logging.info("=== NETFLIX CRAWLER FINISHED ===")
+        logger.info("=== NETFLIX CRAWLER STARTING ===")
+        
+        # Load configuration
+        try:
+            config = Config()
+            logger.info("Configuration loaded successfully")
+        except Exception as e:
+            logger.error("Error loading configuration: %s", e)
+            return
+        
+        # Create crawler
+        try:
+            crawler = NetflixDataCrawler(config)
+            logger.info("Netflix crawler initialized")
+        except Exception as e:
+            logger.error("Error initializing crawler: %s", e)
+            return
+        
+        # Run daily crawl
+        try:
+            with crawler:
+                crawler.crawl_daily_netflix_data(
+                    num_pages_per_source=args.pages,
+                    max_movies=args.max_movies,
+                    sources=args.sources,
+                    resume_from=args.resume
+                )
+            logger.info("Crawling completed successfully")
+        except Exception as e:
+            logger.error("Error during crawling: %s", e)
+            return
+        
+        logger.info("=== NETFLIX CRAWLER FINISHED ===")
+    finally:
+        # Ghi nốt log còn trong queue trước khi thoát
+        stop_logging()
 
 
 if __name__ == "__main__":
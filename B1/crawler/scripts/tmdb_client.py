@@ -5,25 +5,93 @@ Client để gọi The Movie Database API
 
 import os
 import time
+import random
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 from datetime import datetime
 from typing import Dict, Optional, Any, List
 
+try:
+    import orjson
+except ImportError:
+    # orjson là tùy chọn, dùng response.json() nếu chưa được cài
+    orjson = None
+
 try:
     # Import từ thư mục hiện tại khi chạy trực tiếp
-    from cache_manager import CacheManager
+    from cache_manager import CacheManager, NEGATIVE_HIT
 except ImportError:
     # Import đường dẫn tuyệt đối khi chạy trong Docker/Airflow
     import sys
     script_dir = os.path.dirname(os.path.abspath(__file__))
     sys.path.insert(0, script_dir)
-    from cache_manager import CacheManager
+    from cache_manager import CacheManager, NEGATIVE_HIT
+
+class TokenBucket:
+    """
+    Rate limiter kiểu token bucket: cho phép burst tối đa `capacity` request,
+    sau đó nạp lại token với tốc độ `rate` token/giây.
+    """
+    
+    def __init__(self, capacity: int, rate: float):
+        """
+        Khởi tạo token bucket.
+        
+        Args:
+            capacity: Số token tối đa (kích thước burst)
+            rate: Số token được nạp lại mỗi giây
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """
+        Lấy một token, chờ nếu bucket đã hết token.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Giữ chỗ token trước khi chờ để các thread khác xếp hàng phía sau
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class JitteredRetry(Retry):
+    """
+    Retry của urllib3 với backoff ngẫu nhiên (full jitter) để các crawler
+    không retry đồng loạt khi TMDB trả về 429/5xx.
+    """
+    
+    # Thời gian chờ tối đa (giây) giữa các lần retry
+    MAX_BACKOFF = 30.0
+    
+    def get_backoff_time(self):
+        backoff = min(self.MAX_BACKOFF, super().get_backoff_time())
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
 
 class TMDBClient:
     """Client cho The Movie Database (TMDB) API với caching và rate limiting."""
     
+    # Các lỗi client vĩnh viễn được ghi vào negative cache.
+    # 401 không nằm trong danh sách vì đó là lỗi API key, áp dụng cho mọi endpoint.
+    NEGATIVE_CACHE_STATUSES = (403, 404)
+    
+    # Các phần được gộp vào response của movie/{id} qua append_to_response
+    MOVIE_APPENDS = ("credits", "keywords", "videos", "reviews", "similar")
+    FULL_MOVIE_PARAMS = {"append_to_response": ",".join(MOVIE_APPENDS)}
+    
     def __init__(self, config):
         """
         Khởi tạo TMDB client.
@@ -32,37 +100,74 @@ class TMDBClient:
             config: Config object
         """
         self.api_key = config.get("tmdb_api_key")
+        self.access_token = config.get("tmdb_access_token")
         self.base_url = config.get("tmdb_base_url")
         self.image_base_url = config.get("tmdb_image_base_url")
         self.default_language = config.get("default_language", "vi-VN")
         
+        # Prefix URL ảnh cho từng kích thước chuẩn của TMDB
+        self._poster_prefix = {
+            size: f"{self.image_base_url}{size}/"
+            for size in ("w92", "w154", "w185", "w342", "w500", "w780", "original")
+        }
+        
         # API rate limiting
         self.api_delay = config.get("crawler_delay", 0.3)
         self.max_retries = config.get("crawler_max_retries", 3)
         self.timeout = config.get("crawler_timeout", 30)
+        self.max_workers = config.get("max_workers", 5)
         
         # Cache manager
         self.cache = CacheManager(config)
+        # Negative cache mặc định sống bằng cache_ttl (>= một chu kỳ DAG hàng ngày)
+        # để lượt chạy kế tiếp không lặp lại các request đã biết là lỗi
+        self.negative_cache_ttl = config.get("negative_cache_ttl") or config.get("cache_ttl", 86400)
         
-        # Request state
-        self.last_request_time = 0
+        # Rate limiter dùng chung cho mọi request
+        self.bucket = TokenBucket(capacity=10, rate=1.0 / self.api_delay if self.api_delay > 0 else float('inf'))
         
-        if not self.api_key:
+        if not self.api_key and not self.access_token:
             raise ValueError("TMDB API Key không được cung cấp trong cấu hình")
+        
+        # HTTP session dùng chung để tái sử dụng kết nối (keep-alive).
+        # Retry được xử lý ở tầng urllib3 (tôn trọng header Retry-After).
+        self.session = requests.Session()
+        retry = JitteredRetry(
+            total=self.max_retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        # Mọi request đều tới một host nên chỉ cần một pool, đủ lớn cho số worker song song
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(10, 2 * self.max_workers),
+                              pool_block=False, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'User-Agent': 'netflix-crawler/1.0'
+        })
+        # Tham số cố định của mọi request, được requests gộp vào từng request
+        self.session.params = {'language': self.default_language}
+        if self.access_token:
+            # Ưu tiên xác thực bằng Bearer token, không cần gửi api_key trên URL
+            self.session.headers['Authorization'] = f"Bearer {self.access_token}"
+        else:
+            self.session.params['api_key'] = self.api_key
             
-        logging.info(f"TMDBClient đã khởi tạo với base URL: {self.base_url}")
+        logging.info("TMDBClient đã khởi tạo với base URL: %s", self.base_url)
     
-    def _respect_rate_limit(self):
+    def close(self):
         """
-        Đảm bảo tuân thủ rate limit bằng cách thêm delay phù hợp.
+        Đóng HTTP session và kết nối cache.
         """
-        elapsed = time.time() - self.last_request_time
-        if elapsed < self.api_delay:
-            time.sleep(self.api_delay - elapsed)
+        self.session.close()
+        self.cache.close()
     
     def make_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
         """
-        Thực hiện request đến TMDB API với caching và retry.
+        Thực hiện request đến TMDB API với caching (retry do HTTPAdapter đảm nhiệm).
         
         Args:
             endpoint: API endpoint (không bao gồm base URL)
@@ -76,53 +181,44 @@ class TMDBClient:
         
         # Thử lấy từ cache trước
         cached_response = self.cache.get(endpoint, params)
+        if cached_response is NEGATIVE_HIT:
+            logging.debug("Negative cache hit: %s", endpoint)
+            return None
         if cached_response is not None:
             return cached_response
         
-        # Chuẩn bị request parameters
-        request_params = params.copy()
-        request_params['api_key'] = self.api_key
-        request_params['language'] = self.default_language
-        
         url = f"{self.base_url}/{endpoint}"
         
         # Tuân thủ rate limit
-        self._respect_rate_limit()
+        self.bucket.acquire()
         
-        # Retry logic
-        for attempt in range(self.max_retries + 1):
-            try:
-                logging.debug(f"API Request: {endpoint} (attempt {attempt+1}/{self.max_retries+1})")
-                response = requests.get(url, params=request_params, timeout=self.timeout)
-                self.last_request_time = time.time()
-                
-                response.raise_for_status()
+        try:
+            logging.debug("API Request: %s", endpoint)
+            response = self.session.get(url, params=params, timeout=self.timeout)
+            
+            response.raise_for_status()
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("API Response: %s (%s, %d bytes wire / %d bytes decoded)",
+                              endpoint, response.headers.get('Content-Encoding', 'identity'),
+                              response.raw.tell(), len(response.content))
+            if orjson is not None:
+                # Decode trực tiếp từ bytes, lưu nguyên body vào cache
+                data = orjson.loads(response.content)
+                self.cache.set_raw(endpoint, params, response.content, data)
+            else:
                 data = response.json()
-                
-                # Lưu vào cache nếu thành công
                 self.cache.set(endpoint, params, data)
-                return data
-                
-            except requests.exceptions.HTTPError as e:
-                logging.error(f"HTTP error ({e.response.status_code}) khi gọi {endpoint}: {e}")
-                if e.response.status_code in [400, 401, 403, 404]:
-                    # Không cần retry với lỗi client
-                    break
-                
-                # Nếu không phải lần thử cuối, chờ và thử lại
-                if attempt < self.max_retries:
-                    wait_time = 2 ** (attempt + 1)  # Exponential backoff
-                    logging.warning(f"Retrying in {wait_time}s...")
-                    time.sleep(wait_time)
-                    
-            except (requests.exceptions.RequestException, Exception) as e:
-                logging.error(f"Error khi gọi {endpoint}: {e}")
+            return data
+            
+        except requests.exceptions.HTTPError as e:
+            logging.error("HTTP error (%s) khi gọi %s: %s", e.response.status_code, endpoint, e)
+            # Ghi nhận lỗi client vĩnh viễn để không gọi lại
+            if e.response.status_code in self.NEGATIVE_CACHE_STATUSES:
+                self.cache.set_negative(endpoint, params, e.response.status_code,
+                                        ttl=self.negative_cache_ttl)
                 
-                # Nếu không phải lần thử cuối, chờ và thử lại
-                if attempt < self.max_retries:
-                    wait_time = 2 ** (attempt + 1)
-                    logging.warning(f"Retrying in {wait_time}s...")
-                    time.sleep(wait_time)
+        except Exception as e:
+            logging.error("Error khi gọi %s: %s", endpoint, e)
         
         return None
     
@@ -201,6 +297,49 @@ class TMDBClient:
         params = {"page": page}
         return self.make_request(endpoint, params)
     
+    def get_movie_full(self, movie_id: int) -> Optional[Dict]:
+        """
+        Lấy details kèm credits, keywords, videos, reviews và similar trong một request.
+        
+        Args:
+            movie_id: ID của phim
+            
+        Returns:
+            Dict: Thông tin chi tiết của phim, các phần gộp thêm nằm dưới key cùng tên
+        """
+        endpoint = f"movie/{movie_id}"
+        return self.make_request(endpoint, self.FULL_MOVIE_PARAMS)
+    
+    def _get_cached_full(self, movie_id: int) -> Optional[Dict]:
+        """
+        Lấy payload của get_movie_full từ cache (không gọi API).
+        
+        Args:
+            movie_id: ID của phim
+            
+        Returns:
+            Dict: Payload đầy đủ hoặc None nếu chưa có trong cache
+        """
+        full = self.cache.get(f"movie/{movie_id}", self.FULL_MOVIE_PARAMS)
+        return full if isinstance(full, dict) else None
+    
+    def _get_movie_part(self, movie_id: int, part: str, params: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Lấy một phần dữ liệu của phim, ưu tiên payload đầy đủ đã cache.
+        
+        Args:
+            movie_id: ID của phim
+            part: Tên phần dữ liệu (credits, keywords, videos, reviews, similar)
+            params: Dict các parameters query khi phải gọi endpoint riêng
+            
+        Returns:
+            Dict: Dữ liệu của phần được yêu cầu
+        """
+        full = self._get_cached_full(movie_id)
+        if full is not None and part in full:
+            return full[part]
+        return self.make_request(f"movie/{movie_id}/{part}", params)
+    
     def get_movie_details(self, movie_id: int) -> Optional[Dict]:
         """
         Lấy thông tin chi tiết của phim.
@@ -211,6 +350,9 @@ class TMDBClient:
         Returns:
             Dict: Thông tin chi tiết của phim
         """
+        full = self._get_cached_full(movie_id)
+        if full is not None:
+            return {k: v for k, v in full.items() if k not in self.MOVIE_APPENDS}
         endpoint = f"movie/{movie_id}"
         return self.make_request(endpoint)
     
@@ -224,8 +366,7 @@ class TMDBClient:
         Returns:
             Dict: Thông tin về cast và crew
         """
-        endpoint = f"movie/{movie_id}/credits"
-        return self.make_request(endpoint)
+        return self._get_movie_part(movie_id, "credits")
     
     def get_movie_keywords(self, movie_id: int) -> Optional[Dict]:
         """
@@ -237,8 +378,7 @@ class TMDBClient:
         Returns:
             Dict: Keywords của phim
         """
-        endpoint = f"movie/{movie_id}/keywords"
-        return self.make_request(endpoint)
+        return self._get_movie_part(movie_id, "keywords")
     
     def get_movie_videos(self, movie_id: int) -> Optional[Dict]:
         """
@@ -250,8 +390,7 @@ class TMDBClient:
         Returns:
             Dict: Videos của phim
         """
-        endpoint = f"movie/{movie_id}/videos"
-        return self.make_request(endpoint)
+        return self._get_movie_part(movie_id, "videos")
     
     def get_movie_reviews(self, movie_id: int, page: int = 1) -> Optional[Dict]:
         """
@@ -264,9 +403,11 @@ class TMDBClient:
         Returns:
             Dict: Reviews của phim
         """
-        endpoint = f"movie/{movie_id}/reviews"
         params = {"page": page}
-        return self.make_request(endpoint, params)
+        if page != 1:
+            # Payload đầy đủ chỉ chứa trang đầu tiên
+            return self.make_request(f"movie/{movie_id}/reviews", params)
+        return self._get_movie_part(movie_id, "reviews", params)
     
     def get_movie_similar(self, movie_id: int, page: int = 1) -> Optional[Dict]:
         """
@@ -279,9 +420,27 @@ class TMDBClient:
         Returns:
             Dict: Danh sách phim tương tự
         """
-        endpoint = f"movie/{movie_id}/similar"
         params = {"page": page}
-        return self.make_request(endpoint, params)
+        if page != 1:
+            # Payload đầy đủ chỉ chứa trang đầu tiên
+            return self.make_request(f"movie/{movie_id}/similar", params)
+        return self._get_movie_part(movie_id, "similar", params)
+    
+    def fetch_movie_bundle(self, movie_id: int) -> Dict[str, Optional[Dict]]:
+        """
+        Lấy details, credits, keywords, videos, reviews và similar của phim bằng một request.
+        
+        Args:
+            movie_id: ID của phim
+            
+        Returns:
+            Dict: Kết quả của từng phần (None nếu không lấy được)
+        """
+        full = self.get_movie_full(movie_id) or {}
+        bundle = {'details': {k: v for k, v in full.items() if k not in self.MOVIE_APPENDS} or None}
+        for part in self.MOVIE_APPENDS:
+            bundle[part] = full.get(part)
+        return bundle
     
     def get_movie_poster_url(self, poster_path: str, size: str = "w500") -> str:
         """
@@ -296,4 +455,7 @@ class TMDBClient:
         """
         if not poster_path:
             return None
-        return f"{self.image_base_url}{size}/{poster_path}"
\ No newline at end of file
+        prefix = self._poster_prefix.get(size)
+        if prefix is None:
+            prefix = f"{self.image_base_url}{size}/"
+        return prefix + poster_path
\ No newline at end of file